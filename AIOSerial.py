@@ -1,13 +1,24 @@
 import serial
 import asyncio as aio
+import collections
+import concurrent.futures
 import logging
-
-# import the queue class
-from .AIOExtensions.ClosableQueue import ClosableQueue, ClosableQueueClosed
+import os
+import threading
 
 # module logger
 log = logging.getLogger(__name__)
 
+# capacity of the reception buffer. Once it fills up the port is not read
+# until read() makes some room
+RX_BUFFER_SIZE = 64 * 1024
+# number of bytes that may be queued for transmission before write() starts
+# to wait for the port to catch up
+TX_BUFFER_SIZE = 64 * 1024
+# queued chunks are glued together up to this size so that they go out with
+# a single write, larger chunks are written on their own without copying
+TX_COALESCE_SIZE = 4096
+
 # aio serial port exception
 class AIOSerialException(Exception):
     pass
@@ -27,8 +38,95 @@ class AIOSerialClosedException(AIOSerialException):
 class AIOSerialErrorException(AIOSerialException):
     pass
 
+# fixed capacity ring buffer of bytes. Not thread safe on its own, the owner
+# is expected to guard it
+class ByteRing:
+    __slots__ = ('_buf', '_view', '_head', '_size')
+
+    # create the buffer of given capacity
+    def __init__(self, capacity):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        # position of the first byte stored and the number of bytes stored
+        self._head = 0
+        self._size = 0
+
+    # number of bytes stored
+    def __len__(self):
+        return self._size
+
+    # number of bytes that can still be stored
+    def free(self):
+        return len(self._buf) - self._size
+
+    # views of the free space in the order in which it is to be filled. Used
+    # to read straight into the buffer, must be followed by commit()
+    def free_views(self):
+        cap, head = len(self._buf), self._head
+        tail = (head + self._size) % cap
+        # free space is contiguous
+        if tail < head or self._size == cap:
+            return (self._view[tail:head], )
+        # free space wraps around
+        return self._view[tail:], self._view[:head]
+
+    # mark 'n' bytes that were put into the free space as stored
+    def commit(self, n):
+        self._size += n
+
+    # store as much of 'data' as fits, returns the number of bytes stored
+    def write(self, data):
+        data, n = memoryview(data), 0
+        for view in self.free_views():
+            k = min(len(view), len(data) - n)
+            view[:k] = data[n:n + k]
+            n += k
+        self._size += n
+        return n
+
+    # position of the first occurrence of a single byte 'sub' counting from
+    # the first byte stored, -1 if not present. The search skips the first
+    # 'start' bytes
+    def find(self, sub, start=0):
+        cap, head = len(self._buf), self._head
+        begin, end = head + start, head + self._size
+        # search up to the end of the buffer
+        if begin < cap:
+            pos = self._buf.find(sub, begin, min(end, cap))
+            if pos >= 0:
+                return pos - head
+        # search the part that wrapped around
+        if end > cap:
+            pos = self._buf.find(sub, max(begin - cap, 0), end - cap)
+            if pos >= 0:
+                return pos + cap - head
+        return -1
+
+    # remove and return up to 'n' bytes from the beginning
+    def read(self, n):
+        cap, head = len(self._buf), self._head
+        n = min(n, self._size)
+        # data does not wrap around
+        if head + n <= cap:
+            data = bytes(self._view[head:head + n])
+        # glue both parts together
+        else:
+            data = b''.join((self._view[head:], self._view[:head + n - cap]))
+        # empty buffer starts from the beginning so that the data stays
+        # contiguous for as long as possible
+        self._size -= n
+        self._head = (head + n) % cap if self._size else 0
+        return data
+
+
 # serial port asyncio implementation
 class AIOSerial:
+    __slots__ = ('sp', 'line_mode', 'loop', '_fd', '_exec',
+                 '_rx_ring', '_rx_cond', '_rx_evt', '_rx_wake_pending',
+                 '_rx_paused', '_rx_scan', '_rx_exc', '_rx_thread_fut',
+                 '_tx_deque', '_tx_cond', '_tx_size', '_tx_evt', '_tx_waiting',
+                 '_tx_armed', '_tx_flush', '_tx_exc', '_tx_thread_fut', '__weakref__')
+
     # create the serial port
     def __init__(self, *args, line_mode=False, **kwargs):
         # this may fail due to port not being present
@@ -50,15 +148,68 @@ class AIOSerial:
         # behavior for text protocols
         self.line_mode = line_mode
 
-        # reception/transmission queue
-        self._rxq = ClosableQueue()
-        self._txq = ClosableQueue()
+        # reception buffer: filled by the rx side, drained by read(). The
+        # condition guards both the buffer and the 'wake-up pending' flag so
+        # that the rx thread schedules at most one wake-up per batch of data.
+        # The rx thread also sleeps on it while the buffer is full
+        self._rx_ring = ByteRing(RX_BUFFER_SIZE)
+        self._rx_cond = threading.Condition()
+        self._rx_evt = aio.Event()
+        self._rx_wake_pending = False
+        # is the reader callback removed due to the buffer being full?
+        self._rx_paused = False
+        # number of bytes at the beginning of the buffer that are known not
+        # to contain a newline, so that these are not searched again
+        self._rx_scan = 0
+        # exception that read() raises once the buffer is drained
+        self._rx_exc = None
+        # transmission buffer: filled by write(), drained by the tx side. The
+        # tx thread sleeps on the condition while there is nothing to send
+        self._tx_deque = collections.deque()
+        self._tx_cond = threading.Condition()
+        # number of bytes queued, writers wait on the event for the room in
+        # the buffer, the flag tells whether anyone waits for it
+        self._tx_size = 0
+        self._tx_evt = aio.Event()
+        self._tx_waiting = False
+        # is the writer callback registered within the event loop?
+        self._tx_armed = False
+        # future that close() awaits for the buffer to be flushed
+        self._tx_flush = None
+        # exception that write() raises
+        self._tx_exc = None
 
         # get current event loop
         self.loop = aio.get_running_loop()
-        # create receive and transmission tasks
-        self._rx_thread_fut = self.loop.run_in_executor(None, self._rx_thread)
-        self._tx_thread_fut = self.loop.run_in_executor(None, self._tx_thread)
+
+        # on posix systems the port is a selectable file descriptor, so the
+        # event loop can serve it directly without any threads. Windows ports
+        # and proactor event loops do not support that and fall back to the
+        # rx/tx threads
+        try:
+            self._fd = self.sp.fileno()
+            self.loop.add_reader(self._fd, self._on_readable)
+        except (AttributeError, OSError, NotImplementedError):
+            self._fd = None
+
+        # served by the event loop
+        if self._fd is not None:
+            # reads and writes must never block the loop
+            os.set_blocking(self._fd, False)
+            # no threads to wait for
+            self._exec = None
+            self._rx_thread_fut = self._tx_thread_fut = None
+        # served by the threads
+        else:
+            # threads of our own, so that the port is not starved by other
+            # users of the loop's default executor
+            self._exec = concurrent.futures.ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix=f'aios-{self.sp.port}')
+            # create receive and transmission tasks
+            self._rx_thread_fut = self.loop.run_in_executor(self._exec,
+                                                            self._rx_thread)
+            self._tx_thread_fut = self.loop.run_in_executor(self._exec,
+                                                            self._tx_thread)
 
         # log information
         log.info('Serial Port is now opened')
@@ -76,113 +227,365 @@ class AIOSerial:
 
     # close the serial port, do the cleanup
     async def close(self):
-        # port is open?
-        if self.sp.is_open:
-            # cancel ongoing read-write operation to ensure that rx thread is
-            # not stuck inside the read() function
-            self.sp.cancel_read()
-
-        # close both queues
-        self._txq.close()
-        self._rxq.close()
-
-        # wait for the rx/tx thread to end, these need to be gathered to
-        # collect all the exceptions
-        await aio.gather(self._tx_thread_fut, self._rx_thread_fut)
-        
-        # ensure that we call the close function no matter what
-        self.sp.close()
+        # close the reception buffer first so that the rx thread exits as
+        # soon as it returns from the read() function
+        self._rx_close(AIOSerialClosedException("Serial Port is closed"))
+        # close the transmission buffer, write() accepts nothing from now on
+        self._tx_close(AIOSerialClosedException("Serial Port is closed"))
+
+        # whatever happens, release the threads and the port
+        try:
+            # port served by the event loop
+            if self._fd is not None:
+                # port is open? the descriptor is not ours to touch otherwise
+                if self.sp.is_open:
+                    # send out what write() has already accepted, the writer
+                    # stays armed until the buffer is flushed or the port
+                    # fails
+                    if self._tx_armed:
+                        self._tx_flush = self.loop.create_future()
+                        await self._tx_flush
+                    # stop watching the port
+                    self.loop.remove_reader(self._fd)
+                    self.loop.remove_writer(self._fd)
+            # port served by the threads
+            else:
+                # the tx thread sends out what write() has already accepted
+                # and ends afterwards
+                await aio.wait((self._tx_thread_fut, ))
+                # port is open?
+                if self.sp.is_open:
+                    # cancel ongoing read operation to ensure that rx thread
+                    # is not stuck inside the read() function
+                    self.sp.cancel_read()
+                # wait for the rx/tx thread to end, these need to be gathered
+                # to collect all the exceptions
+                await aio.gather(self._tx_thread_fut, self._rx_thread_fut)
+        finally:
+            # threads are done, release them
+            if self._exec is not None:
+                self._exec.shutdown(wait=False)
+            # ensure that we call the close function no matter what
+            self.sp.close()
 
         # log information
         log.info('Serial Port is now closed')
 
     # reception thread
     def _rx_thread(self):
-        # get the proper read function according to mode
-        read_func = self.sp.readline if self.line_mode else self.sp.read
-        # putting into the rx queue may fail, read may fail as well
+        # look up everything that is used within the loop only once
+        sp, store, debug = self.sp, self._rx_store, log.debug
+
+        # read everything that is already waiting in the driver's buffer (or
+        # block for at least one byte) so that a burst of data is delivered
+        # as a single chunk. This is used in line mode as well, read() splits
+        # the lines itself, while readline() would read byte by byte
+        def read_burst():
+            return sp.read(sp.in_waiting or 1)
+
+        # storing into the rx buffer may fail, read may fail as well
         try:
-            # this loop can only be broken by exceptions
+            # this loop is broken by exceptions or by closing the buffer
             while True:
                 # read from the port
-                data = read_func()
-                # try putting the data to the queue, this will raise an
-                # exception when queue is closed which is in turn caused by the
-                # port itself getting closed. we use the result to
-                # raise the exception if any was thrown by the _rxq.put()
-                aio.run_coroutine_threadsafe(self._rxq.put(data),
-                                             self.loop).result()
+                data = read_burst()
+                # store the data unless the buffer was closed which is in
+                # turn caused by the port itself getting closed
+                if not store(data):
+                    break
                 # log information
-                log.debug(f'Serial Port RX Thread: {data}')
-        # queue closed exception raised? exit the loop gracefully (no
-        # exceptions) as this can only happen when the port is getting
-        # intentionally closed
-        except ClosableQueueClosed:
-            pass
+                debug('Serial Port RX Thread: %s', data)
         # serial port exceptions, all of these notify that we are in some
-        # serious trouble
-        except serial.SerialException:
+        # serious trouble. in_waiting reports a disconnected device with a
+        # plain OSError rather than with serial.SerialException
+        except OSError:
             # log message
             log.error('Serial Port RX error')
-            # create the exception of our own
-            e = AIOSerialErrorException("Serial Port Reception Error")
-            # close the queue
-            aio.run_coroutine_threadsafe(aio.coroutine(self._rxq.close)(e),
-                                            self.loop)
+            # close the buffer with the exception of our own
+            self._rx_close(AIOSerialErrorException("Serial Port Reception "
+                                                   "Error"))
         # log information
         log.info('Serial Port RX Thread has ended')
-                
+
+    # store the data read by the rx thread, blocks for as long as the
+    # reception buffer is full. Returns False if the buffer got closed
+    def _rx_store(self, data):
+        data = memoryview(data)
+        with self._rx_cond:
+            while True:
+                # no one is going to read that
+                if self._rx_exc is not None:
+                    return False
+                # store what fits
+                n = self._rx_ring.write(data)
+                data = data[n:]
+                # only the first chunk of the batch needs to wake up the
+                # reader, the rest will be picked up along with it
+                if n and not self._rx_wake_pending:
+                    self._rx_wake_pending = True
+                    self.loop.call_soon_threadsafe(self._rx_wakeup)
+                # all stored
+                if not data:
+                    return True
+                # wait for read() to make some room
+                self._rx_cond.wait()
+
+    # close the reception buffer, read() will raise 'exc' once all the data
+    # that was received before is consumed. May be called from any thread
+    def _rx_close(self, exc):
+        with self._rx_cond:
+            # keep the first exception, it tells the real reason
+            if self._rx_exc is None:
+                self._rx_exc = exc
+            # release the rx thread if it waits for the room in the buffer
+            self._rx_cond.notify()
+            need_wake = not self._rx_wake_pending
+            self._rx_wake_pending = True
+        # wake the reader up so that it notices the closure
+        if need_wake:
+            self.loop.call_soon_threadsafe(self._rx_wakeup)
+
+    # executed within the event loop on behalf of the rx thread
+    def _rx_wakeup(self):
+        # allow the rx thread to schedule the next wake-up
+        with self._rx_cond:
+            self._rx_wake_pending = False
+        # release the reader
+        self._rx_evt.set()
+
+    # called by the event loop when the port has data to be read
+    def _on_readable(self):
+        # this may fail due to the device being disconnected
+        try:
+            # read straight into the reception buffer
+            n = os.readv(self._fd, self._rx_ring.free_views())
+        # spurious wake-up
+        except BlockingIOError:
+            return
+        # serial port exceptions, all of these notify that we are in some
+        # serious trouble
+        except OSError:
+            n = 0
+        # end of file on a tty means that the device has hung up
+        if not n:
+            # log message
+            log.error('Serial Port RX error')
+            # stop watching the port, otherwise we will spin here
+            self.loop.remove_reader(self._fd)
+            # close the buffer with the exception of our own
+            self._rx_close(AIOSerialErrorException("Serial Port Reception "
+                                                   "Error"))
+            return
+        # store the data and release the reader
+        with self._rx_cond:
+            self._rx_ring.commit(n)
+            # buffer is full, stop reading until read() makes some room
+            if not self._rx_ring.free():
+                self.loop.remove_reader(self._fd)
+                self._rx_paused = True
+        self._rx_evt.set()
+        # log information
+        log.debug('Serial Port RX: %d bytes', n)
+
+    # called by the event loop when the port is able to accept more data
+    def _on_writable(self):
+        # keep writing for as long as the port takes everything
+        while True:
+            with self._tx_cond:
+                # all was sent, no need to watch the port anymore
+                if not self._tx_deque:
+                    self.loop.remove_writer(self._fd)
+                    self._tx_armed = False
+                    self._tx_flushed()
+                    break
+                # take the data to be sent
+                data = self._tx_take()
+            # this may fail due to the device being disconnected
+            try:
+                n = os.write(self._fd, data)
+            # port buffer is full after all
+            except BlockingIOError:
+                n = 0
+            # serial port related exceptions
+            except OSError:
+                # log message
+                log.error('Serial Port TX error')
+                # nothing more will be sent
+                self.loop.remove_writer(self._fd)
+                self._tx_armed = False
+                # close the buffer with the exception of our own
+                self._tx_close(AIOSerialErrorException("Serial Port "
+                                                       "Transmission Error"))
+                # nothing more to wait for
+                self._tx_flushed()
+                return
+            # log information
+            log.debug('Serial Port TX: %d bytes', n)
+            # put back whatever did not fit (without copying it), we'll be
+            # called again once the port is ready
+            if n < len(data):
+                with self._tx_cond:
+                    self._tx_deque.appendleft(memoryview(data)[n:])
+                    self._tx_size += len(data) - n
+                break
+        # writers waiting for the room may proceed
+        if self._tx_waiting and self._tx_size < TX_BUFFER_SIZE:
+            self._tx_waiting = False
+            self._tx_evt.set()
+
+    # release close() waiting for the transmission buffer to be flushed
+    def _tx_flushed(self):
+        if self._tx_flush is not None and not self._tx_flush.done():
+            self._tx_flush.set_result(None)
+
     # transmission thread
     def _tx_thread(self):
-        # this may fail due to serial port or queue
+        # look up everything that is used within the loop only once
+        cond, queued, take = self._tx_cond, self._tx_deque, self._tx_take
+        write, debug = self.sp.write, log.debug
+        # this may fail due to serial port
         try:
-            # this loop can only be broken by exceptions
+            # this loop is broken by exceptions or by closing the buffer
             while True:
-                # try getting data from the queue, this will raise an
-                # exception when queue is closed due to the fact that port is
-                # getting closed
-                data = aio.run_coroutine_threadsafe(self._txq.get(),
-                                                    self.loop).result()
+                # wait for the data to be sent
+                with cond:
+                    while not queued and self._tx_exc is None:
+                        cond.wait()
+                    # buffer closed due to the fact that port is getting
+                    # closed and everything queued before was sent
+                    if not queued:
+                        break
+                    # take the data to be sent
+                    data = take()
+                    # writers waiting for the room may proceed
+                    if self._tx_waiting and self._tx_size < TX_BUFFER_SIZE:
+                        self._tx_waiting = False
+                        self.loop.call_soon_threadsafe(self._tx_evt.set)
                 # write the data to the serial port
-                self.sp.write(data)
+                write(data)
                 # log information
-                log.debug(f'Serial Port TX Thread: {data}')
-        # queue closed exception raised? exit the loop gracefully (no
-        # exceptions) as this can only happen when the port is getting
-        # intentionally closed
-        except ClosableQueueClosed:
-            pass
+                debug('Serial Port TX Thread: %d bytes', len(data))
         # serial port related exceptions
         except serial.SerialException:
             # log message
             log.error('Serial Port TX error')
-            # create the exception of our own
-            e = AIOSerialErrorException("Serial Port Transmission Error")
-            # close the queue
-            aio.run_coroutine_threadsafe(aio.coroutine(self._txq.close)(e),
-                                            self.loop)
+            # close the buffer with the exception of our own
+            self._tx_close(AIOSerialErrorException("Serial Port Transmission "
+                                                   "Error"))
         # log information
-        log.info('Serial Port RX Thread has ended')
+        log.info('Serial Port TX Thread has ended')
+
+    # take the data to be sent next, called with the tx condition held.
+    # Small chunks are glued together so that they go out with a single write,
+    # large ones are sent as they are instead of being copied
+    def _tx_take(self):
+        queued = self._tx_deque
+        data = queued.popleft()
+        # glue the following chunks for as long as these stay small
+        if len(data) < TX_COALESCE_SIZE:
+            chunks, size = [data], len(data)
+            while queued and size + len(queued[0]) <= TX_COALESCE_SIZE:
+                chunks.append(queued.popleft())
+                size += len(chunks[-1])
+            if len(chunks) > 1:
+                data = b''.join(chunks)
+        self._tx_size -= len(data)
+        return data
+
+    # close the transmission buffer, write() will raise 'exc' from now on.
+    # May be called from any thread
+    def _tx_close(self, exc):
+        with self._tx_cond:
+            # keep the first exception, it tells the real reason
+            if self._tx_exc is None:
+                self._tx_exc = exc
+            # release the tx thread
+            self._tx_cond.notify()
+            # release the writers so that they notice the closure
+            if self._tx_waiting:
+                self._tx_waiting = False
+                self.loop.call_soon_threadsafe(self._tx_evt.set)
 
     # read from serial port
     async def read(self):
-        # port might get closed
-        try:
-            # get data from the queue
-            return await self._rxq.get()
-        # closed queue means closed port
-        except ClosableQueueClosed:
-            raise AIOSerialClosedException("Serial Port is closed")
+        # wait until there is something to return
+        while True:
+            with self._rx_cond:
+                ring = self._rx_ring
+                # data is available
+                if ring:
+                    # not in line mode: return everything that was received
+                    # so far
+                    if not self.line_mode:
+                        end = len(ring)
+                    # line mode returns one full line at a time
+                    else:
+                        end = ring.find(b'\n', self._rx_scan) + 1
+                        # no full line yet, remember how far we got
+                        self._rx_scan = 0 if end else len(ring)
+                        # no more data is to come or no room for the rest of
+                        # the line: return the unterminated tail
+                        if not end and (self._rx_exc is not None or
+                                        not ring.free()):
+                            end = len(ring)
+                            self._rx_scan = 0
+                    # got something to return?
+                    if end:
+                        data = ring.read(end)
+                        # there is some room now, release the rx thread
+                        self._rx_cond.notify()
+                        # resume reading the port
+                        if self._rx_paused and self._rx_exc is None:
+                            self.loop.add_reader(self._fd, self._on_readable)
+                            self._rx_paused = False
+                        return data
+                # buffer is empty and closed, port is closed or has failed.
+                # Every call gets an exception instance of its own so that
+                # the tracebacks do not pile up on a shared one
+                elif self._rx_exc is not None:
+                    raise type(self._rx_exc)(*self._rx_exc.args)
+            # buffer was found empty in this very loop iteration so any
+            # wake-up that follows will be caused by the new data
+            self._rx_evt.clear()
+            await self._rx_evt.wait()
 
     # write to serial port
     async def write(self, data):
-        # unsupported type of data
-        if not isinstance(data, (bytes, bytearray)):
-            raise TypeError("Data must be of type bytes or bytearray")
-        # port might get closed
+        # any contiguous bytes-like object is accepted, the cast makes len()
+        # count bytes for any item format
         try:
-            # put data to port
-            await self._txq.put(data)
-        # closed queue means closed port
-        except ClosableQueueClosed:
-            raise AIOSerialClosedException("Serial Port is closed")
+            data = memoryview(data).cast('B')
+        # unsupported type of data
+        except TypeError:
+            raise TypeError("Data must be a contiguous bytes-like "
+                            "object") from None
+        # data backed by immutable bytes is queued without copying, anything
+        # else is copied so that the caller is free to reuse (or resize) the
+        # buffer as soon as this returns. A read-only view says nothing about
+        # the memory underneath, hence the check of the owning object
+        if not isinstance(data.obj, bytes):
+            data = bytes(data)
+        # wait until there is room in the buffer
+        while True:
+            with self._tx_cond:
+                # closed buffer means closed port, every call gets an
+                # exception instance of its own so that the tracebacks do not
+                # pile up on a shared one
+                if self._tx_exc is not None:
+                    raise type(self._tx_exc)(*self._tx_exc.args)
+                # put data to the buffer and wake the tx thread up
+                if self._tx_size < TX_BUFFER_SIZE:
+                    self._tx_deque.append(data)
+                    self._tx_size += len(data)
+                    self._tx_cond.notify()
+                    break
+                # let the tx side know that we are waiting
+                self._tx_waiting = True
+            # the tx side sets the event only after seeing the flag, which
+            # cannot happen before we get to clear it
+            self._tx_evt.clear()
+            await self._tx_evt.wait()
+        # port served by the event loop: wait for it to become writable
+        if self._fd is not None and not self._tx_armed:
+            self.loop.add_writer(self._fd, self._on_writable)
+            self._tx_armed = True